@@ -1,43 +1,106 @@
 import os
+import re
+import mmap
+import struct
 import shutil
 import subprocess
 import zipfile
 import xml.etree.ElementTree as ET
 import tempfile
 import logging
+import threading
 import time
 from xml.dom import minidom
 
-logger = logging.getLogger(__name__)
+logger = logging.getLogger("dexapi.injector")
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# Absolute path so subprocess can take its posix_spawn fast path
+JAVA_BIN = shutil.which("java") or "java"
+
+# rm -rf walks big decoded trees far faster than shutil.rmtree; resolved once
+FAST_RM = shutil.which("rm")
+
+# Prefix of process_apk workspaces, lets the server sweep ones left behind
+WORKSPACE_PREFIX = "apkwork_"
+
+# Each java run reserves up to -Xmx2G; cap how many run at once so concurrent
+# requests queue for a slot instead of overcommitting memory. The cap is per
+# process: gunicorn_conf.py splits the host's budget across its workers
+JVM_SLOTS = threading.BoundedSemaphore(int(os.environ.get("JVM_SLOTS", os.cpu_count() or 1)))
+
+# Only this much of a failed command's log goes into the error, apktool
+# can write megabytes of progress before the actual failure
+LOG_TAIL_SIZE = 4096
+# Failures process_apk recovers from, searched for in the whole log
+RECOVERABLE_ERRORS = (
+    (b"unbound prefix", "XML namespace error - recovery attempted"),
+    (b"duplicate attribute", "Duplicate attribute error - recovery attempted"),
+)
+
+def scan_log(log_path):
+    """Return the recovery message for the first marker in the log and its tail"""
+    recovery = None
+    with open(log_path, "rb") as log_file:
+        for line in log_file:
+            if recovery is None:
+                recovery = next(
+                    (message for marker, message in RECOVERABLE_ERRORS if marker in line),
+                    None
+                )
+        log_file.seek(max(0, log_file.tell() - LOG_TAIL_SIZE))
+        return recovery, log_file.read().decode(errors="replace").strip()
 
 # ===== Advanced Command Execution =====
-def run_command(cmd, cwd=None, timeout=300):
+def run_command(cmd, cwd=None, timeout=300, log_path=None):
     """Execute command with robust error handling"""
     try:
-        logger.debug(f"Executing: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE, 
-            cwd=cwd,
-            timeout=timeout
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Executing: %s", " ".join(cmd))
+        # Python's own fds are non-inheritable already (PEP 446), so
+        # close_fds=False only skips the fd sweep and allows posix_spawn
+        with JVM_SLOTS:
+            if log_path:
+                with open(log_path, "wb") as log_file:
+                    result = subprocess.run(
+                        cmd,
+                        stdout=log_file,
+                        stderr=subprocess.STDOUT,
+                        cwd=cwd,
+                        timeout=timeout,
+                        close_fds=False
+                    )
+            else:
+                result = subprocess.run(
+                    cmd, 
+                    stdout=subprocess.PIPE, 
+                    stderr=subprocess.PIPE, 
+                    cwd=cwd,
+                    timeout=timeout,
+                    close_fds=False
+                )
         
         if result.returncode != 0:
-            error_output = result.stderr.decode().strip()
-            logger.error(f"Command failed ({result.returncode}): {error_output}")
+            # A log file is streamed for the markers, only its tail is kept
+            if log_path:
+                recovery, error_output = scan_log(log_path)
+            else:
+                error_output = result.stderr.decode().strip()
+                recovery = next(
+                    (message for marker, message in RECOVERABLE_ERRORS
+                     if marker.decode() in error_output),
+                    None
+                )
+            logger.error("Command failed (%s): %s", result.returncode, error_output)
             
             # Special handling for resource errors
-            if "unbound prefix" in error_output:
-                logger.warning("Detected XML namespace error, attempting recovery")
-                raise RuntimeError("XML namespace error - recovery attempted")
-            elif "duplicate attribute" in error_output:
-                logger.warning("Detected duplicate attribute error")
-                raise RuntimeError("Duplicate attribute error - recovery attempted")
+            if recovery:
+                logger.warning("Detected recoverable resource error: %s", recovery)
+                raise RuntimeError(recovery)
                 
             raise RuntimeError(f"Command error: {error_output}")
         
-        return result.stdout.decode()
+        return "" if log_path else result.stdout.decode()
     except subprocess.TimeoutExpired:
         logger.error(f"Timeout exceeded for command: {' '.join(cmd)}")
         raise RuntimeError("Process timeout")
@@ -45,6 +108,25 @@ def run_command(cmd, cwd=None, timeout=300):
         logger.error(f"Unexpected execution error: {str(e)}")
         raise
 
+# ===== JVM Launch =====
+def java_command(jar_path, *args, max_heap="2G", short_run=False):
+    """Build a `java -jar` command line, using the jar's AppCDS archive when present"""
+    cmd = [JAVA_BIN, f"-Xmx{max_heap}"]
+    # Runs of a few seconds finish before C2 would pay off
+    if short_run:
+        cmd.append("-XX:TieredStopAtLevel=1")
+    cds_archive = os.path.splitext(jar_path)[0] + ".jsa"
+    if os.path.exists(cds_archive):
+        cmd.append(f"-XX:SharedArchiveFile={cds_archive}")
+    return cmd + ["-jar", jar_path, *args]
+
+def remove_tree(path):
+    """Delete a directory tree, via rm -rf when available"""
+    if FAST_RM:
+        subprocess.run([FAST_RM, "-rf", "--", path], check=False, close_fds=False)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
 # ===== XML Validation =====
 def validate_xml(xml_path):
     """Validate XML file structure"""
@@ -131,6 +213,66 @@ def fix_resource_issues(decode_dir):
                     logger.error(f"Failed to delete public.xml: {str(e_remove)}")
 
 # ===== Smali Injection =====
+def next_smali_dir_name(decode_dir):
+    """Name of the smali dir apktool will assemble into the first free classesN.dex"""
+    indices = []
+    for name in os.listdir(decode_dir):
+        match = re.fullmatch(r"classes(\d*)\.dex", name)
+        if match:
+            indices.append(int(match.group(1) or 1))
+    
+    if not indices:
+        return "smali"
+    return f"smali_classes{max(indices) + 1}"
+
+# Fixed size of a DEX header, the offsets read below all live in it
+DEX_HEADER_SIZE = 0x70
+
+def dex_defines_class(data, descriptor):
+    """Whether a DEX image has a class_def for the type descriptor, False if unparsable"""
+    # Follow class_defs -> type_ids -> string_ids, plain references don't count
+    if len(data) < DEX_HEADER_SIZE:
+        return False
+    string_ids_size, string_ids_off, type_ids_size, type_ids_off = struct.unpack_from("<IIII", data, 0x38)
+    class_defs_size, class_defs_off = struct.unpack_from("<II", data, 0x60)
+    if class_defs_off + class_defs_size * 32 > len(data):
+        return False
+    
+    expected = descriptor + b"\0"
+    try:
+        for i in range(class_defs_size):
+            type_idx, = struct.unpack_from("<I", data, class_defs_off + i * 32)
+            if type_idx >= type_ids_size:
+                return False
+            string_idx, = struct.unpack_from("<I", data, type_ids_off + type_idx * 4)
+            if string_idx >= string_ids_size:
+                return False
+            string_off, = struct.unpack_from("<I", data, string_ids_off + string_idx * 4)
+            # Skip the uleb128 UTF-16 length that precedes the MUTF-8 bytes
+            while data[string_off] & 0x80:
+                string_off += 1
+            string_off += 1
+            if data[string_off:string_off + len(expected)] == expected:
+                return True
+    except (struct.error, IndexError):
+        return False
+    return False
+
+def find_class_dex(decode_dir, app_class):
+    """Return the raw DEX in decode_dir that defines the class, if any"""
+    descriptor = b"L" + app_class.replace(".", "/").encode() + b";"
+    for name in sorted(os.listdir(decode_dir)):
+        if not re.fullmatch(r"classes(\d*)\.dex", name):
+            continue
+        dex_path = os.path.join(decode_dir, name)
+        if os.path.getsize(dex_path) == 0:
+            continue
+        with open(dex_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Byte search in C rules out most DEX files before any parsing
+            if data.find(descriptor) != -1 and dex_defines_class(data, descriptor):
+                return dex_path
+    return None
+
 def inject_application(decode_dir, smali_file_path, app_class):
     """Inject custom application class"""
     try:
@@ -142,7 +284,15 @@ def inject_application(decode_dir, smali_file_path, app_class):
         ]
         
         if not smali_dirs:
-            raise RuntimeError("No smali directories found")
+            # Already protected APKs must not get a second copy of the class
+            existing_dex = find_class_dex(decode_dir, app_class)
+            if existing_dex:
+                logger.info("✅ %s already present in %s, skipping injection", app_class, existing_dex)
+                return True
+            
+            # Sources were not decoded: the class goes into its own extra dex
+            smali_dirs = [os.path.join(decode_dir, next_smali_dir_name(decode_dir))]
+            logger.info("Injecting into new dex source dir: %s", smali_dirs[0])
         
         # Convert class to path
         class_path = app_class.replace(".", "/")
@@ -165,7 +315,7 @@ def inject_application(decode_dir, smali_file_path, app_class):
         if not os.path.exists(target_file):
             raise RuntimeError("File copy failed")
         
-        logger.info(f"✅ Injected application to: {target_file}")
+        logger.info("✅ Injected application to: %s", target_file)
         return True
     except Exception as e:
         logger.error(f"❌ Injection failed: {str(e)}")
@@ -182,7 +332,7 @@ def modify_manifest(manifest_path, app_class):
         # Backup original manifest
         backup_path = manifest_path + ".bak"
         shutil.copyfile(manifest_path, backup_path)
-        logger.info(f"Created manifest backup: {backup_path}")
+        logger.info("Created manifest backup: %s", backup_path)
         
         # Validate XML structure
         if not validate_xml(manifest_path):
@@ -217,7 +367,7 @@ def modify_manifest(manifest_path, app_class):
                 root.attrib['xmlns:tools'] = tools_ns
                 logger.info("Added tools namespace to manifest")
         else:
-            logger.info(f"Tools namespace already present as '{tools_prefix}'")
+            logger.info("Tools namespace already present as '%s'", tools_prefix)
         
         # 2. Find application tag with multiple strategies
         app_tag = None
@@ -244,7 +394,7 @@ def modify_manifest(manifest_path, app_class):
         current_class = app_tag.get(android_name)
         
         if current_class:
-            logger.info(f"Replacing existing application class: {current_class}")
+            logger.info("Replacing existing application class: %s", current_class)
         else:
             logger.info("No existing application class found")
         
@@ -305,25 +455,27 @@ def modify_manifest(manifest_path, app_class):
         return False
 
 # ===== APK Processing Pipeline =====
-def process_apk(apk_path, apktool_path, smali_file_path, app_class):
+def process_apk(apk_path, apktool_path, smali_file_path, app_class, decode_sources=False):
     """Main APK processing workflow with enhanced error recovery"""
     # Create temp workspace
-    tmpdir = tempfile.mkdtemp()
-    logger.info(f"📁 Temp workspace: {tmpdir}")
+    tmpdir = tempfile.mkdtemp(prefix=WORKSPACE_PREFIX)
+    logger.info("📁 Temp workspace: %s", tmpdir)
     
     try:
         # Step 1: Decode APK
         decode_dir = os.path.join(tmpdir, "decoded")
-        logger.info(f"🔧 Decoding APK to: {decode_dir}")
+        logger.info("🔧 Decoding APK to: %s", decode_dir)
         
-        decode_cmd = [
-            "java", "-Xmx2G", "-jar", apktool_path, "d",  # Increased memory
+        decode_cmd = java_command(
+            apktool_path, "d",
             "--use-aapt2",  # Use modern resource compiler
             "--force",      # Force overwrite
             apk_path,
             "-o", decode_dir
-        ]
-        run_command(decode_cmd, timeout=600)
+        )
+        if not decode_sources:
+            decode_cmd.insert(-3, "--no-src")  # Keep original DEX files untouched
+        run_command(decode_cmd, timeout=600, log_path=os.path.join(tmpdir, "apktool_decode.log"))
         
         # Step 2: Fix resource issues
         fix_resource_issues(decode_dir)
@@ -379,18 +531,19 @@ def process_apk(apk_path, apktool_path, smali_file_path, app_class):
         
         # Step 5: Rebuild APK with aapt2
         output_apk = os.path.join(tmpdir, "protected.apk")
-        logger.info(f"🔧 Rebuilding APK to: {output_apk}")
+        logger.info("🔧 Rebuilding APK to: %s", output_apk)
         
-        build_cmd = [
-            "java", "-Xmx2G", "-jar", apktool_path, "b",  # Increased memory
-            decode_dir, 
+        build_cmd = java_command(
+            apktool_path, "b",
+            decode_dir,
             "-o", output_apk,
             "--use-aapt2"  # Ensure using modern resource compiler
-        ]
+        )
         
         # Attempt build with recovery mechanism
+        build_log = os.path.join(tmpdir, "apktool_build.log")
         try:
-            run_command(build_cmd, timeout=600)
+            run_command(build_cmd, timeout=600, log_path=build_log)
         except RuntimeError as e:
             if "XML namespace error" in str(e) or "Duplicate attribute error" in str(e):
                 logger.warning("Resource error detected, attempting recovery")
@@ -400,7 +553,7 @@ def process_apk(apk_path, apktool_path, smali_file_path, app_class):
                 manifest_path = os.path.join(decode_dir, "AndroidManifest.xml")
                 
                 if os.path.exists(public_xml):
-                    logger.info(f"Removing potentially problematic file: {public_xml}")
+                    logger.info("Removing potentially problematic file: %s", public_xml)
                     os.remove(public_xml)
                     
                 # Remove duplicate tools namespace from manifest
@@ -418,38 +571,48 @@ def process_apk(apk_path, apktool_path, smali_file_path, app_class):
                     logger.error(f"Failed to fix manifest: {str(manifest_fix_error)}")
                 
                 # Retry build
-                run_command(build_cmd, timeout=600)
+                run_command(build_cmd, timeout=600, log_path=build_log)
             else:
                 raise
         
         # Step 6: Create output package
         output_zip = os.path.join(tmpdir, "protected.zip")
-        logger.info(f"📦 Creating output package: {output_zip}")
+        logger.info("📦 Creating output package: %s", output_zip)
         
-        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        # DEX barely deflates, so store it and skip the zlib pass entirely
+        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_STORED) as zipf:
             with zipfile.ZipFile(output_apk, 'r') as apk_zip:
-                # Add all DEX files
-                for file in apk_zip.namelist():
+                # Add all DEX files, streamed member to member in 1 MiB chunks
+                for info in apk_zip.infolist():
+                    file = info.filename
                     if file.startswith("classes") and file.endswith(".dex"):
-                        zipf.writestr(file, apk_zip.read(file))
-                        logger.debug(f"Added: {file}")
+                        entry = zipfile.ZipInfo(file, date_time=info.date_time)
+                        entry.file_size = info.file_size  # Lets zipfile pick ZIP64 up front
+                        with apk_zip.open(info) as src, zipf.open(entry, 'w') as dst:
+                            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+                        logger.debug("Added: %s", file)
                 
                 # Add manifest
                 if "AndroidManifest.xml" in apk_zip.namelist():
-                    zipf.writestr("AndroidManifest.xml", apk_zip.read("AndroidManifest.xml"))
+                    zipf.writestr(
+                        "AndroidManifest.xml",
+                        apk_zip.read("AndroidManifest.xml"),
+                        compress_type=zipfile.ZIP_DEFLATED,
+                        compresslevel=1
+                    )
         
         # Validate output
         if not os.path.exists(output_zip):
             raise RuntimeError("Output ZIP creation failed")
         
         size_mb = os.path.getsize(output_zip) / (1024 * 1024)
-        logger.info(f"✅ Created output: {output_zip} ({size_mb:.2f} MB)")
+        logger.info("✅ Created output: %s (%.2f MB)", output_zip, size_mb)
         return output_zip, tmpdir
         
     except Exception as e:
         # Cleanup on failure
         try:
-            shutil.rmtree(tmpdir, ignore_errors=True)
+            remove_tree(tmpdir)
         except Exception as cleanup_err:
             logger.error(f"Cleanup error: {str(cleanup_err)}")
         
@@ -0,0 +1,45 @@
+# Gunicorn settings for the APK protection server
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# apktool/java run as subprocesses that release the GIL, so threads keep
+# /health and friends responsive while long /upload jobs are running
+workers = int(os.environ.get("WEB_CONCURRENCY", max(2, os.cpu_count() or 1)))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# JVM_SLOTS is enforced per process; share one host-wide budget (cpu count
+# by default, or JVM_SLOTS_TOTAL) between the workers
+os.environ.setdefault("JVM_SLOTS", str(max(
+    1, int(os.environ.get("JVM_SLOTS_TOTAL", os.cpu_count() or 1)) // workers
+)))
+worker_class = "gthread"
+timeout = 600
+
+# Worker recycling is opt-in (GUNICORN_MAX_REQUESTS): every request counts,
+# /health and /result polls included, and a recycled worker drops its
+# cleanup schedule and any ?async=1 jobs still running in its job pool
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = 50 if max_requests else 0
+# Long grace so restarts and deploys let running jobs finish
+graceful_timeout = timeout
+
+# Import the app once in the master; workers share its memory copy-on-write
+preload_app = True
+# server.py then leaves its threads (log listener, reaper) to post_fork
+os.environ["DEXAPI_SERVICES_AFTER_FORK"] = "1"
+
+def post_fork(server, worker):
+    """Threads do not survive fork, start the app's per-worker services"""
+    from server import start_background_services
+    start_background_services()
+
+# Heartbeat files on tmpfs so a busy disk cannot stall workers
+worker_tmp_dir = "/dev/shm"
+
+accesslog = "-"
+errorlog = "-"
+
+# send_file hands output archives to wsgi.file_wrapper, gunicorn then
+# pushes them with sendfile(2) instead of copying through Python
+sendfile = True
@@ -1,23 +1,40 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, request, send_file
 import os
-import uuid
+import functools
 import logging
-import traceback
+import logging.handlers
+import queue
+import atexit
 from datetime import datetime
 import threading
 import time
+import heapq
+import hashlib
+import secrets
+import fcntl
 import psutil
 import tempfile
 import shutil
 import subprocess
 import zipfile
-from dex_injector import process_apk
+from concurrent.futures import ThreadPoolExecutor, wait
+import orjson
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget
+import dex_injector
+from dex_injector import process_apk, java_command, run_command, remove_tree, WORKSPACE_PREFIX
 
 # ===== Advanced System Setup =====
 def setup_logger():
     """Configure advanced logging system"""
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    # Own logger tree (dex_injector logs under "dexapi.injector") that does
+    # not propagate, so records never pass through root/third-party handlers
+    logger = logging.getLogger("dexapi")
+    logger.propagate = False
+    # INFO in production, LOG_LEVEL=DEBUG for troubleshooting
+    logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
     
     # Unified formatter for all handlers
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(process)d - %(message)s')
@@ -27,9 +44,8 @@ def setup_logger():
     error_handler.setLevel(logging.WARNING)
     error_handler.setFormatter(formatter)
     
-    # Console info handler
+    # Console handler, shows whatever LOG_LEVEL lets through
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(formatter)
     
     logger.addHandler(error_handler)
@@ -38,89 +54,489 @@ def setup_logger():
     return logger
 
 logger = setup_logger()
+log_listener = None
+# Cap on records waiting for the listener, so a stalled stderr or disk
+# cannot grow memory without bound; overflow is dropped, not blocked on
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that counts and drops records when the queue is full"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """QueueListener whose stop waits for room in a full queue"""
+    def enqueue_sentinel(self):
+        # The listener thread is still draining, so a blocking put returns
+        self.queue.put(self._sentinel)
+
+def start_log_listener():
+    """Put the dexapi handlers behind a queue drained by one listener thread"""
+    global log_listener
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    log_listener = DrainingQueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    log_listener.start()
+
+@atexit.register
+def stop_log_listener():
+    """Flush queued records on shutdown"""
+    if log_listener:
+        log_listener.stop()
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config.update(
     MAX_CONTENT_LENGTH=100 * 1024 * 1024,  # 100MB
     TEMP_FILE_TIMEOUT=300,  # 5 minutes for temp files
+    ORPHAN_TIMEOUT=3600,  # 1 hour for untracked job directories
+    CLEANUP_INTERVAL=30,  # Orphan sweep period in seconds
     UPLOAD_DIR=tempfile.gettempdir()
 )
 
+# Let a fronting Apache/lighttpd stream output files with sendfile(2)
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE") == "1"
+# Behind nginx, hand files off with X-Accel-Redirect to two internal locations,
+#   location /_internal/jobs/  { internal; alias <UPLOAD_DIR>/; }
+#   location /_internal/cache/ { internal; alias <OUTPUT_CACHE_DIR>/; }
+# Job dirs are 0700, so nginx workers must run as the same user as this app
+USE_XACCEL = os.environ.get("USE_XACCEL") == "1"
+XACCEL_PREFIX = os.environ.get("XACCEL_PREFIX", "/_internal")
+# nginx reads the file after the response closes, keep it around longer
+XACCEL_CLEANUP_DELAY = 600
+
+def ojsonify(obj, status=200):
+    """JSON response serialized with orjson"""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
 # Tool paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 APKTOOL_PATH = os.path.join(BASE_DIR, "apktool.jar")
+SMALI_PATH = os.path.join(BASE_DIR, "smali.jar")
 MYAPP_SMALI_PATH = os.path.join(BASE_DIR, "MyApp.smali")
 MYAPP_CLASS = "com.abnsafita.protection.MyApp"
+# Baksmali every DEX instead of adding the class as an extra DEX
+# (needed only for pre-Lollipop targets without multidex support)
+DECODE_SOURCES = os.environ.get("DECODE_SOURCES") == "1"
+JOB_DIR_PREFIXES = ("apkjob_", "assemblejob_", WORKSPACE_PREFIX)
+# Finished /upload outputs keyed by APK hash; kept out of the orphan sweep
+OUTPUT_CACHE_DIR = os.environ.get(
+    "OUTPUT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dexapi_cache")
+)
+OUTPUT_CACHE_SIZE = int(os.environ.get("OUTPUT_CACHE_SIZE", 32))
 
 # ===== Advanced Temp File Manager =====
+# Fixed pool for rmtree work so one huge tree doesn't stall the reaper
+cleanup_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cleanup")
+
+# Bounded pool for apktool pipelines: each one runs a -Xmx2G JVM, so the
+# pool caps memory while request threads only wait on (or poll) the result
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 1))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="apkjob")
+
+# Shared pool for inflating smali bundles; zlib drops the GIL while inflating
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", os.cpu_count() or 1))
+extract_executor = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="extract")
+
 class TempFileManager:
     """Centralized temp file management"""
     def __init__(self):
         self.active_jobs = {}
         self.lock = threading.Lock()
+        # (expiry_time, job_dir) min-heap; entries are re-checked when popped
+        self.expiry_heap = []
+        self.wakeup = threading.Condition(self.lock)
     
     def create_job_dir(self, prefix):
-        """Create tracked temp directory"""
-        job_id = str(uuid.uuid4())
-        job_dir = os.path.join(app.config['UPLOAD_DIR'], f"{prefix}_{job_id}")
-        os.makedirs(job_dir, exist_ok=True)
+        """Create tracked temp directory, in flight until schedule_cleanup"""
+        # The suffix is the job id and all /result asks for, so it comes from secrets
+        job_dir = os.path.join(app.config['UPLOAD_DIR'], f"{prefix}_{secrets.token_urlsafe(16)}")
+        os.mkdir(job_dir, 0o700)
         
+        now = time.time()
         with self.lock:
             self.active_jobs[job_dir] = {
-                "created": time.time(),
-                "last_access": time.time(),
+                "created": now,
                 "size": 0
             }
         
-        logger.info(f"Created temp directory: {job_dir}")
+        logger.info("Created temp directory: %s", job_dir)
         return job_dir
     
-    def update_access(self, job_dir):
-        """Update last access time"""
+    def attach_future(self, job_dir, future):
+        """Track the background job writing into a directory"""
         with self.lock:
             if job_dir in self.active_jobs:
-                self.active_jobs[job_dir]["last_access"] = time.time()
+                self.active_jobs[job_dir]["future"] = future
     
     def schedule_cleanup(self, job_dir, delay=None):
-        """Schedule directory cleanup"""
+        """Mark directory for removal by the reaper thread"""
         if delay is None:
             delay = app.config['TEMP_FILE_TIMEOUT']
         
-        def cleanup():
-            logger.info(f"⏳ Waiting {delay}s before cleaning {job_dir}")
-            time.sleep(delay)
-            try:
-                if os.path.exists(job_dir):
-                    # Calculate directory size
-                    size = 0
-                    for path, _, files in os.walk(job_dir):
-                        for f in files:
-                            fp = os.path.join(path, f)
-                            size += os.path.getsize(fp)
-                    
-                    shutil.rmtree(job_dir, ignore_errors=True)
-                    logger.info(f"🧹 Cleaned {job_dir} (Size: {size/(1024*1024):.2f} MB)")
-                    
-                    with self.lock:
-                        if job_dir in self.active_jobs:
-                            del self.active_jobs[job_dir]
-            except Exception as e:
-                logger.error(f"❌ Cleanup failed: {str(e)}")
+        now = time.time()
+        with self.lock:
+            info = self.active_jobs.setdefault(job_dir, {
+                "created": now,
+                "size": 0
+            })
+            info["expires"] = now + delay
+            self._push_expiry(info["expires"], job_dir)
         
-        threading.Thread(target=cleanup, daemon=True).start()
+        logger.info("⏳ Scheduled cleanup of %s in %ss", job_dir, delay)
+    
+    def _push_expiry(self, expires, job_dir):
+        """Queue an expiry check and wake the reaper (caller holds the lock)"""
+        heapq.heappush(self.expiry_heap, (expires, job_dir))
+        self.wakeup.notify()
+    
+    def _current_expiry(self, info, now):
+        """Effective expiry of a tracked job, in-flight and running jobs are never due"""
+        if "expires" not in info or ("future" in info and not info["future"].done()):
+            return now + app.config['CLEANUP_INTERVAL']
+        return info["expires"]
+    
+    def remove_dir(self, job_dir):
+        """Delete a job directory tree"""
+        try:
+            if os.path.exists(job_dir):
+                remove_tree(job_dir)
+                logger.info("🧹 Cleaned %s", job_dir)
+        except Exception as e:
+            logger.error(f"❌ Cleanup failed: {str(e)}")
     
     def cleanup_expired(self):
-        """Clean up all expired temp files"""
+        """Remove tracked jobs whose expiry has passed, O(log n) per entry"""
+        now = time.time()
+        expired = []
+        
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                _, job_dir = heapq.heappop(self.expiry_heap)
+                info = self.active_jobs.get(job_dir)
+                if info is None:
+                    continue  # Stale entry for an already removed job
+                
+                # Running jobs and rescheduled dirs are not due yet
+                expires = self._current_expiry(info, now)
+                if expires > now:
+                    heapq.heappush(self.expiry_heap, (expires, job_dir))
+                    continue
+                
+                del self.active_jobs[job_dir]
+                expired.append(job_dir)
+        
+        for job_dir in expired:
+            cleanup_executor.submit(self.remove_dir, job_dir)
+    
+    def sweep_orphans(self):
+        """Remove untracked job directories from previous processes or workers"""
+        now = time.time()
         with self.lock:
-            now = time.time()
-            for job_dir, info in list(self.active_jobs.items()):
-                if now - info["last_access"] > app.config['TEMP_FILE_TIMEOUT']:
-                    self.schedule_cleanup(job_dir, delay=0)
+            tracked = set(self.active_jobs)
+        
+        # Only once they are well past any possible job duration
+        orphan_timeout = app.config['ORPHAN_TIMEOUT']
+        with os.scandir(app.config['UPLOAD_DIR']) as entries:
+            for entry in entries:
+                if not entry.name.startswith(JOB_DIR_PREFIXES) or entry.path in tracked:
+                    continue
+                try:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                except FileNotFoundError:
+                    continue  # Another worker removed it first
+                if now - mtime > orphan_timeout:
+                    cleanup_executor.submit(self.remove_dir, entry.path)
+    
+    def run_reaper(self):
+        """Sleep until the next expiry or orphan sweep, whichever comes first"""
+        sweep_interval = app.config['CLEANUP_INTERVAL']
+        next_sweep = time.time() + sweep_interval
+        while True:
+            with self.wakeup:
+                deadline = next_sweep
+                if self.expiry_heap:
+                    deadline = min(deadline, self.expiry_heap[0][0])
+                delay = deadline - time.time()
+                if delay > 0:
+                    self.wakeup.wait(timeout=delay)
+            
+            try:
+                self.cleanup_expired()
+                if time.time() >= next_sweep:
+                    self.sweep_orphans()
+                    next_sweep = time.time() + sweep_interval
+            except Exception as e:
+                logger.error(f"Background cleaner error: {str(e)}")
 
 # Initialize file manager
 file_manager = TempFileManager()
 
+def send_job_file(path, download_name, mimetype, cleanup_dirs):
+    """Send an output file and schedule cleanup of its job dirs"""
+    uri = xaccel_uri(path) if USE_XACCEL else None
+    if uri:
+        response = app.response_class(mimetype=mimetype, headers={
+            "X-Accel-Redirect": uri,
+            "Content-Disposition": f'attachment; filename="{download_name}"'
+        })
+        delay = XACCEL_CLEANUP_DELAY
+    else:
+        response = send_file(
+            path,
+            as_attachment=True,
+            download_name=download_name,
+            mimetype=mimetype,
+            conditional=True
+        )
+        delay = None
+    
+    # Not from call_on_close, which never runs for send_file's passthrough
+    # responses; the open file (or the delay, for nginx) covers the download
+    for job_dir in cleanup_dirs:
+        file_manager.schedule_cleanup(job_dir, delay)
+    
+    return response
+
+def publish_file(src_path, dest_path):
+    """Link (or copy) src_path to a temporary name, then rename it to dest_path"""
+    partial = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        os.link(src_path, partial)
+    except OSError:
+        shutil.copyfile(src_path, partial)
+    os.replace(partial, dest_path)
+
+# ===== Output Cache =====
+class OutputCache:
+    """LRU of protected.zip outputs keyed by a digest of the input APK"""
+    # The directory is the only index, entry mtimes mark last use, so all
+    # gunicorn workers see and trim the same set
+    def __init__(self, cache_dir, max_entries):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        # Outputs also depend on the decode mode, the toolchain and our code
+        self.salt = b"sources" if DECODE_SOURCES else b"no-src"
+        for path in (APKTOOL_PATH, MYAPP_SMALI_PATH, dex_injector.__file__):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    self.salt += hashlib.file_digest(f, "blake2b").digest()
+        
+        self.trim()
+    
+    def key_for(self, apk_path):
+        """Hash an uploaded APK into a cache key"""
+        with open(apk_path, "rb") as f:
+            digest = hashlib.file_digest(f, "blake2b")
+        digest.update(self.salt)
+        return digest.hexdigest()
+    
+    def get(self, key):
+        """Return the cached output path for key, or None"""
+        path = os.path.join(self.cache_dir, f"{key}.zip")
+        try:
+            # Touch on hit so eviction sees it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+    
+    def put(self, key, output_path):
+        """Store a finished output, hard-linked when on the same filesystem"""
+        path = os.path.join(self.cache_dir, f"{key}.zip")
+        try:
+            publish_file(output_path, path)
+            os.utime(path)
+            self.trim()
+        except OSError as e:
+            # The caller's output is still good, only the cache misses out
+            logger.warning("Output cache store failed: %s", e)
+    
+    def trim(self):
+        """Unlink the least recently used entries beyond max_entries and stale .part files"""
+        now = time.time()
+        entries = []
+        stale = []
+        with self.lock, os.scandir(self.cache_dir) as listing:
+            for entry in listing:
+                try:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(".zip"):
+                    entries.append((mtime, entry.path))
+                elif (entry.name.endswith(".part")
+                        and now - mtime > app.config['ORPHAN_TIMEOUT']):
+                    stale.append(entry.path)
+            
+            entries.sort(reverse=True)
+            for path in stale + [path for _, path in entries[self.max_entries:]]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+output_cache = OutputCache(OUTPUT_CACHE_DIR, OUTPUT_CACHE_SIZE)
+
+# Internal nginx locations by the directory they alias
+XACCEL_ROOTS = (
+    ("cache", os.path.abspath(OUTPUT_CACHE_DIR)),
+    ("jobs", os.path.abspath(app.config['UPLOAD_DIR'])),
+)
+
+def xaccel_uri(path):
+    """Internal nginx URI for path, or None if no location aliases it"""
+    path = os.path.abspath(path)
+    for name, root in XACCEL_ROOTS:
+        if path.startswith(root + os.sep):
+            return f"{XACCEL_PREFIX}/{name}/{os.path.relpath(path, root)}"
+    return None
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Local file header signature every APK/ZIP upload starts with
+ZIP_MAGIC = b"PK\x03\x04"
+
+class MagicValidator:
+    """Per-chunk upload validator, UnsupportedMediaType on the first chunk with wrong magic"""
+    def __init__(self, magic):
+        self.magic = magic
+        self.head = b""
+    
+    def __call__(self, chunk):
+        missing = len(self.magic) - len(self.head)
+        if missing > 0:
+            self.head += chunk[:missing]
+            if not self.magic.startswith(self.head):
+                raise UnsupportedMediaType()
+    
+    def matched(self):
+        return self.head == self.magic
+
+def receive_upload(field, dest_path, magic=ZIP_MAGIC):
+    """Stream one uploaded file straight to disk, returns its client filename or None"""
+    max_length = app.config['MAX_CONTENT_LENGTH']
+    received = 0
+    validator = MagicValidator(magic)
+    
+    if request.mimetype == "application/octet-stream":
+        with open(dest_path, "wb") as f:
+            while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                if received > max_length:
+                    raise RequestEntityTooLarge()
+                validator(chunk)
+                f.write(chunk)
+        if not validator.matched():
+            raise UnsupportedMediaType()
+        return request.args.get("filename", os.path.basename(dest_path))
+    
+    # streaming-form-data skips Werkzeug's form parser and its spooled temp file
+    target = FileTarget(dest_path, validator=validator)
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register(field, target)
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            received += len(chunk)
+            if received > max_length:
+                raise RequestEntityTooLarge()
+            parser.data_received(chunk)
+    except ParseFailedException as e:
+        logger.warning("Rejected upload body: %s", e)
+        return None
+    
+    if target.multipart_filename is not None and not validator.matched():
+        raise UnsupportedMediaType()
+    return target.multipart_filename
+
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+# Upper bound on the uncompressed size of an uploaded ZIP (zip-bomb guard)
+MAX_EXTRACT_SIZE = 500 * 1024 * 1024
+
+def _extract_members(zip_path, members):
+    """Extract a slice of members through this thread's own ZipFile handle"""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for info, target in members:
+            with zip_ref.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, EXTRACT_BUFFER_SIZE)
+
+class RejectedArchive(Exception):
+    """Uploaded ZIP refused as a client error, status is the HTTP code to answer"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def extract_zip(zip_path, dest_dir):
+    """Extract a ZIP in parallel, RejectedArchive for unsafe, oversized or corrupt archives"""
+    try:
+        dest_root = os.path.normpath(dest_dir)
+        directories = {dest_root}
+        members = []
+        total_size = 0
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                target = os.path.normpath(os.path.join(dest_root, info.filename))
+                if not target.startswith(dest_root + os.sep):
+                    raise RejectedArchive(f"Unsafe path in ZIP: {info.filename}")
+                
+                # zipfile never inflates past the declared size, so summing it is enough
+                total_size += info.file_size
+                if total_size > MAX_EXTRACT_SIZE:
+                    raise RejectedArchive("ZIP expands beyond the allowed size", 413)
+                
+                if not info.is_dir():
+                    members.append((info, target))
+                    target = os.path.dirname(target)
+                # Record every missing ancestor so each one needs a single mkdir
+                while target not in directories:
+                    directories.add(target)
+                    target = os.path.dirname(target)
+        
+        # Sorted order puts parents before children, so plain mkdir is enough
+        os.makedirs(dest_root, exist_ok=True)
+        for directory in sorted(directories - {dest_root}):
+            try:
+                os.mkdir(directory)
+            except FileExistsError:
+                pass
+        
+        # One contiguous slice per worker keeps the per-thread ZipFile opens low
+        slices = min(EXTRACT_WORKERS, len(members))
+        if slices <= 1:
+            _extract_members(zip_path, members)
+            return
+        size = -(-len(members) // slices)
+        futures = [
+            extract_executor.submit(_extract_members, zip_path, members[i:i + size])
+            for i in range(0, len(members), size)
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            # No slice may still be writing once the caller removes dest_dir
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            raise
+    except zipfile.BadZipFile as e:
+        raise RejectedArchive(f"Invalid ZIP archive: {e}")
+
 # ===== Enhanced API Endpoints =====
 @app.route("/")
 def home():
@@ -129,7 +545,70 @@ def home():
 @app.before_request
 def log_request():
     """Log incoming requests"""
-    logger.info(f"📥 Incoming: {request.method} {request.url}")
+    logger.info("📥 Incoming: %s %s", request.method, request.url)
+
+@app.before_request
+def reject_oversized():
+    """Refuse oversized uploads from the header, before any body is read"""
+    content_length = request.content_length
+    if content_length and content_length > app.config['MAX_CONTENT_LENGTH']:
+        logger.warning("Rejected %s byte request to %s", content_length, request.path)
+        return ojsonify({"error": "Request body too large"}, 413)
+
+# Present only in async job dirs, flock'ed by the process running the job;
+# the kernel drops the lock if that process dies
+JOB_LOCK_NAME = "job.lock"
+
+def hold_job_lock(job_dir):
+    """Create and lock job_dir's lock file, returns the fd to close when done"""
+    fd = os.open(os.path.join(job_dir, JOB_LOCK_NAME), os.O_CREAT | os.O_WRONLY, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+def job_lock_held(job_dir):
+    """Whether some live process still holds job_dir's lock"""
+    fd = os.open(os.path.join(job_dir, JOB_LOCK_NAME), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+def job_id_of(job_dir):
+    """Public id of a job dir, the random suffix after its prefix"""
+    return os.path.basename(job_dir).split("_", 1)[1]
+
+def record_failure(job_dir, error):
+    """Leave an async job's error where /result finds it"""
+    with open(os.path.join(job_dir, "error.txt"), "w") as f:
+        f.write(str(error))
+
+def run_job(job_dir, lock_fd, pipeline, *args):
+    """Run an async pipeline, then release the job lock and schedule cleanup"""
+    try:
+        pipeline(job_dir, *args)
+    except RejectedArchive as e:
+        logger.warning("Rejected archive (job %s): %s", job_id_of(job_dir), e)
+        record_failure(job_dir, e)
+    except Exception as e:
+        logger.exception("Async job error (job %s)", job_id_of(job_dir))
+        record_failure(job_dir, e)
+    finally:
+        os.close(lock_fd)
+        file_manager.schedule_cleanup(job_dir)
+
+def submit_job(job_dir, pipeline, *args):
+    """Queue pipeline(job_dir, *args) and answer with the id to poll /result with"""
+    lock_fd = hold_job_lock(job_dir)
+    try:
+        future = job_executor.submit(run_job, job_dir, lock_fd, pipeline, *args)
+    except BaseException:
+        os.close(lock_fd)
+        raise
+    file_manager.attach_future(job_dir, future)
+    return ojsonify({"job_id": job_id_of(job_dir), "status": "pending"}, 202)
 
 @app.route("/upload", methods=["POST"])
 def upload_apk():
@@ -137,51 +616,69 @@ def upload_apk():
     tmpdir = None
     
     try:
-        # Validate APK file
-        if 'apk' not in request.files:
-            return jsonify(error="Missing 'apk' field"), 400
-            
-        apk_file = request.files['apk']
-        if not apk_file.filename.lower().endswith('.apk'):
-            return jsonify(error="File must be APK format"), 400
-
-        # Create job directory
+        # Create job directory and stream the upload into it
         job_dir = file_manager.create_job_dir("apkjob")
         apk_path = os.path.join(job_dir, "input.apk")
-        apk_file.save(apk_path)
-        logger.info(f"💾 Saved APK: {os.path.getsize(apk_path)/(1024*1024):.2f} MB")
+        filename = receive_upload('apk', apk_path)
+        
+        # Validate APK file
+        if filename is None:
+            file_manager.schedule_cleanup(job_dir, delay=0)
+            return ojsonify({"error": "Missing 'apk' field"}, 400)
+        if not filename.lower().endswith('.apk'):
+            file_manager.schedule_cleanup(job_dir, delay=0)
+            return ojsonify({"error": "File must be APK format"}, 400)
+        
+        logger.info("💾 Saved APK: %.2f MB", os.path.getsize(apk_path)/(1024*1024))
+        cache_key = output_cache.key_for(apk_path)
+
+        # ?async=1 returns a job id right away, poll /result/<job_id>
+        if request.args.get("async") == "1":
+            return submit_job(job_dir, run_upload_job, apk_path, cache_key)
+
+        # Same APK already processed, skip apktool entirely
+        cached_zip = output_cache.get(cache_key)
+        if cached_zip:
+            logger.info("♻️ Output cache hit: %s", cache_key[:16])
+            return send_job_file(
+                cached_zip,
+                download_name="protected.zip",
+                mimetype='application/zip',
+                cleanup_dirs=[job_dir]
+            )
 
         # Process APK with CORRECTED parameter names
-        output_zip, tmpdir = process_apk(
+        future = job_executor.submit(
+            process_apk,
             apk_path=apk_path,
             apktool_path=APKTOOL_PATH,
             smali_file_path=MYAPP_SMALI_PATH,
-            app_class=MYAPP_CLASS
+            app_class=MYAPP_CLASS,
+            decode_sources=DECODE_SOURCES
         )
+        file_manager.attach_future(job_dir, future)
+        output_zip, tmpdir = future.result()
 
         # Validate output
         if not os.path.exists(output_zip):
             raise FileNotFoundError("Output file creation failed")
+        output_cache.put(cache_key, output_zip)
 
-        # Update access time
-        file_manager.update_access(job_dir)
-        if tmpdir:
-            file_manager.update_access(tmpdir)
-
-        # Send response
-        response = send_file(
+        # Send response, which also schedules cleanup
+        return send_job_file(
             output_zip,
-            as_attachment=True,
             download_name="protected.zip",
-            mimetype='application/zip'
+            mimetype='application/zip',
+            cleanup_dirs=[job_dir, tmpdir]
         )
 
-        # Schedule cleanup
-        file_manager.schedule_cleanup(job_dir)
-        if tmpdir:
-            file_manager.schedule_cleanup(tmpdir)
+    except RequestEntityTooLarge:
+        file_manager.schedule_cleanup(job_dir, delay=0)
+        return ojsonify({"error": "Request body too large"}, 413)
 
-        return response
+    except UnsupportedMediaType:
+        file_manager.schedule_cleanup(job_dir, delay=0)
+        return ojsonify({"error": "APK file is not a ZIP archive"}, 415)
 
     except Exception as e:
         # Immediate cleanup on error
@@ -190,118 +687,229 @@ def upload_apk():
         if tmpdir:
             file_manager.schedule_cleanup(tmpdir, delay=0)
 
-        logger.exception("APK processing error")
-        return jsonify(
-            error=str(e), 
-            traceback=traceback.format_exc()
-        ), 500
+        job_id = job_id_of(job_dir) if job_dir else None
+        logger.exception("APK processing error (job %s)", job_id)
+        return ojsonify({"error": str(e), "request_id": job_id}, 500)
+
+def run_upload_job(job_dir, apk_path, cache_key):
+    """Background /upload pipeline, publishes job_dir/protected.zip"""
+    result_path = os.path.join(job_dir, "protected.zip")
+    cached_zip = output_cache.get(cache_key)
+    if cached_zip:
+        publish_file(cached_zip, result_path)
+        return
+    
+    output_zip, tmpdir = process_apk(
+        apk_path=apk_path,
+        apktool_path=APKTOOL_PATH,
+        smali_file_path=MYAPP_SMALI_PATH,
+        app_class=MYAPP_CLASS,
+        decode_sources=DECODE_SOURCES
+    )
+    output_cache.put(cache_key, output_zip)
+    os.replace(output_zip, result_path)
+    file_manager.schedule_cleanup(tmpdir, delay=0)
+
+# Files an async job publishes once done: (file, download name, mimetype)
+ASYNC_RESULTS = {
+    "apkjob": [("protected.zip", "protected.zip", "application/zip")],
+    "assemblejob": [
+        ("dex_files.zip", "dex_files.zip", "application/zip"),
+        ("result.dex", "classes.dex", "application/octet-stream")
+    ]
+}
+
+@app.route("/result/<job_id>", methods=["GET"])
+def job_result(job_id):
+    """Fetch the output of an /upload?async=1 or /assemble?async=1 job"""
+    for prefix, outputs in ASYNC_RESULTS.items():
+        job_dir = os.path.join(app.config['UPLOAD_DIR'], f"{prefix}_{job_id}")
+        if os.path.isdir(job_dir):
+            break
+    else:
+        return ojsonify({"error": "Job not found"}, 404)
+    
+    # Sync jobs have no lock file and never publish a result here
+    if not os.path.exists(os.path.join(job_dir, JOB_LOCK_NAME)):
+        return ojsonify({"error": "Job not found"}, 404)
+    
+    # Second pass once the lock is free: the job may have just finished
+    error_path = os.path.join(job_dir, "error.txt")
+    for running in (job_lock_held(job_dir), False):
+        for file_name, download_name, mimetype in outputs:
+            output_path = os.path.join(job_dir, file_name)
+            if os.path.exists(output_path):
+                return send_job_file(
+                    output_path,
+                    download_name=download_name,
+                    mimetype=mimetype,
+                    cleanup_dirs=[job_dir]
+                )
+        
+        if os.path.exists(error_path):
+            with open(error_path) as f:
+                return ojsonify({"job_id": job_id, "status": "failed", "error": f.read()}, 500)
+        
+        if running:
+            return ojsonify({"job_id": job_id, "status": "pending"}, 202)
+    
+    return ojsonify({
+        "job_id": job_id,
+        "status": "failed",
+        "error": "Job worker exited before finishing"
+    }, 500)
+
+def assemble_dex(job_dir, zip_path):
+    """Extract an uploaded smali ZIP and assemble it into job_dir/classes.dex"""
+    # Extract straight into the directory smali assembles from
+    smali_dir = os.path.join(job_dir, "smali")
+    extract_zip(zip_path, smali_dir)
+
+    # Assemble Smali straight to DEX, no throwaway APK build
+    dex_output = os.path.join(job_dir, "classes.dex")
+    run_command(
+        java_command(SMALI_PATH, "a", smali_dir, "-o", dex_output, short_run=True),
+        timeout=300,
+        log_path=os.path.join(job_dir, "smali.log")
+    )
+
+    # Validate output
+    if not os.path.exists(dex_output):
+        raise FileNotFoundError("No DEX file produced")
+    logger.info("Assembled DEX: %.2f MB", os.path.getsize(dex_output)/(1024*1024))
+    return dex_output
+
+def package_dex(dex_files, dex_zip):
+    """Bundle DEX files into a stored ZIP"""
+    # Renamed into place, /result never sees a half-written archive
+    partial = f"{dex_zip}.part"
+    with zipfile.ZipFile(partial, 'w', zipfile.ZIP_STORED) as zipf:
+        for dex in dex_files:
+            zipf.write(dex, os.path.basename(dex))
+    os.replace(partial, dex_zip)
+
+def run_assemble_job(job_dir, zip_path, raw_dex):
+    """Background /assemble pipeline, publishes result.dex or dex_files.zip"""
+    dex_output = assemble_dex(job_dir, zip_path)
+    if raw_dex:
+        os.replace(dex_output, os.path.join(job_dir, "result.dex"))
+    else:
+        package_dex([dex_output], os.path.join(job_dir, "dex_files.zip"))
 
 @app.route("/assemble", methods=["POST"])
 def assemble_smali():
     job_dir = None
     
     try:
-        if 'smali' not in request.files:
-            return jsonify(error="Missing 'smali' field"), 400
-
-        # Create job directory
+        # Create job directory and stream the upload into it
         job_dir = file_manager.create_job_dir("assemblejob")
         zip_path = os.path.join(job_dir, "smali.zip")
-        request.files['smali'].save(zip_path)
-        logger.info(f"💾 Saved Smali ZIP: {os.path.getsize(zip_path)/(1024*1024):.2f} MB")
-
-        # Extract files
-        smali_dir = os.path.join(job_dir, "smali")
-        os.makedirs(smali_dir, exist_ok=True)
+        if receive_upload('smali', zip_path) is None:
+            file_manager.schedule_cleanup(job_dir, delay=0)
+            return ojsonify({"error": "Missing 'smali' field"}, 400)
         
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(smali_dir)
+        logger.info("💾 Saved Smali ZIP: %.2f MB", os.path.getsize(zip_path)/(1024*1024))
+        raw_dex = request.args.get("format") == "dex"
 
-        # Assemble Smali to APK
-        temp_apk_dir = os.path.join(job_dir, "temp_apk")
-        os.makedirs(temp_apk_dir, exist_ok=True)
-        shutil.move(smali_dir, os.path.join(temp_apk_dir, "smali"))
+        if request.args.get("async") == "1":
+            return submit_job(job_dir, run_assemble_job, zip_path, raw_dex)
 
-        temp_apk = os.path.join(job_dir, "temp.apk")
-        result = subprocess.run(
-            ["java", "-Xmx2G", "-jar", APKTOOL_PATH, "b", temp_apk_dir, "-o", temp_apk, "-f"],  # Increased memory
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=300
-        )
-        
-        if result.returncode != 0:
-            logger.error(f"❌ APK build failed: {result.stderr}")
-            raise RuntimeError(f"APK assembly failed: {result.stderr}")
-
-        # Extract DEX files
-        dex_files = []
-        with zipfile.ZipFile(temp_apk, 'r') as apk_zip:
-            for file in apk_zip.namelist():
-                if file.startswith("classes") and file.endswith(".dex"):
-                    output_path = os.path.join(job_dir, file)
-                    apk_zip.extract(file, job_dir)
-                    dex_files.append(output_path)
-                    logger.info(f"Extracted DEX: {file}")
-
-        # Validate extraction
-        if not dex_files:
-            raise FileNotFoundError("No DEX files found in APK")
+        dex_output = assemble_dex(job_dir, zip_path)
+
+        # ?format=dex skips packaging, smali always assembles to one DEX
+        if raw_dex:
+            return send_job_file(
+                dex_output,
+                download_name="classes.dex",
+                mimetype='application/octet-stream',
+                cleanup_dirs=[job_dir]
+            )
 
         # Create DEX package
         dex_zip = os.path.join(job_dir, "dex_files.zip")
-        with zipfile.ZipFile(dex_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for dex in dex_files:
-                zipf.write(dex, os.path.basename(dex))
-        
-        # Update access time
-        file_manager.update_access(job_dir)
+        package_dex([dex_output], dex_zip)
 
-        response = send_file(
-            dex_zip, 
-            as_attachment=True, 
+        return send_job_file(
+            dex_zip,
             download_name="dex_files.zip",
-            mimetype='application/zip'
+            mimetype='application/zip',
+            cleanup_dirs=[job_dir]
         )
 
-        # Schedule cleanup
-        file_manager.schedule_cleanup(job_dir)
-        return response
+    except RequestEntityTooLarge:
+        file_manager.schedule_cleanup(job_dir, delay=0)
+        return ojsonify({"error": "Request body too large"}, 413)
+
+    except UnsupportedMediaType:
+        file_manager.schedule_cleanup(job_dir, delay=0)
+        return ojsonify({"error": "Smali upload is not a ZIP archive"}, 415)
+
+    except RejectedArchive as e:
+        file_manager.schedule_cleanup(job_dir, delay=0)
+        logger.warning("Rejected smali ZIP: %s", e)
+        return ojsonify({"error": str(e)}, e.status)
 
     except Exception as e:
         if job_dir:
             file_manager.schedule_cleanup(job_dir, delay=0)
-        logger.exception("Smali assembly error")
-        return jsonify(
-            error=str(e), 
-            traceback=traceback.format_exc()
-        ), 500
+        job_id = job_id_of(job_dir) if job_dir else None
+        logger.exception("Smali assembly error (job %s)", job_id)
+        return ojsonify({"error": str(e), "request_id": job_id}, 500)
 
 # ===== System Monitoring Endpoints =====
-@app.route("/health", methods=["GET"])
-def health_check():
-    """Comprehensive system health check"""
+@functools.lru_cache(maxsize=1)
+def get_java_version():
+    """Probe the Java runtime once, it cannot change while the process runs"""
+    try:
+        result = subprocess.run(
+            ["java", "-version"],
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            timeout=5
+        )
+        return result.returncode == 0, (result.stderr or result.stdout).strip()
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return False, str(e)
+
+@functools.lru_cache(maxsize=1)
+def get_tool_files():
+    """Presence of the bundled tool files, fixed for the image's lifetime"""
+    return {
+        "apktool": os.path.exists(APKTOOL_PATH),
+        "smali": os.path.exists(SMALI_PATH),
+        "myapp_smali": os.path.exists(MYAPP_SMALI_PATH)
+    }
+
+# Probe at startup so no health check ever pays for the JVM fork
+get_java_version()
+get_tool_files()
+
+HEALTH_CACHE_TTL = 1  # seconds
+_health_cache = (0.0, b"")
+
+def build_health_status(now):
+    """Collect the full health report"""
     health_status = {
         "status": "OK",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.utcfromtimestamp(now).isoformat(),
         "version": "5.0",
         "components": {}
     }
     
     try:
         # Check essential files
-        health_status["components"]["apktool"] = os.path.exists(APKTOOL_PATH)
-        health_status["components"]["myapp_smali"] = os.path.exists(MYAPP_SMALI_PATH)
+        health_status["components"].update(get_tool_files())
         
         # Check Java availability
-        java_result = subprocess.run(
-            ["java", "-version"],
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            timeout=5
+        java_ok, java_version = get_java_version()
+        health_status["components"]["java"] = java_ok
+        health_status["java_version"] = java_version.splitlines()[0] if java_version else ""
+        
+        # Log records lost to a full logging queue in this worker
+        health_status["log_records_dropped"] = sum(
+            getattr(handler, "dropped", 0) for handler in logger.handlers
         )
-        health_status["components"]["java"] = java_result.returncode == 0
         
         # Disk space check
         disk = psutil.disk_usage('/')
@@ -331,33 +939,74 @@ def health_check():
         health_status["status"] = "ERROR"
         health_status["error"] = str(e)
     
-    return jsonify(health_status)
+    return health_status
+
+@app.route("/health", methods=["GET"])
+def health_check():
+    """Comprehensive system health check, cached for load balancer polling"""
+    global _health_cache
+    
+    # ?nocache=1 re-probes everything for manual diagnostics
+    nocache = request.args.get("nocache") == "1"
+    if nocache:
+        get_java_version.cache_clear()
+        get_tool_files.cache_clear()
+    
+    now = time.time()
+    cached_at, body = _health_cache
+    if nocache or now - cached_at > HEALTH_CACHE_TTL:
+        body = orjson.dumps(build_health_status(now))
+        _health_cache = (now, body)
+    
+    return app.response_class(body, mimetype='application/json')
+
+# Boot time never changes; cpu_percent(interval=None) reports usage since the
+# previous call, so prime it here instead of sleeping a second per request
+BOOT_TIME = psutil.boot_time()
+psutil.cpu_percent(interval=None)
+
+# Pollers within this window share one snapshot; it also keeps concurrent
+# callers from splitting cpu_percent's since-last-call window into slivers
+RESOURCES_CACHE_TTL = 0.5
+_resources_cache = (0.0, None)
+_resources_lock = threading.Lock()
+
+def build_resource_snapshot():
+    """Serialized memory/CPU metrics"""
+    mem = psutil.virtual_memory()
+    
+    # Convert bytes to MB
+    def to_mb(bytes_val):
+        return round(bytes_val / (1024 * 1024), 2)
+    
+    return orjson.dumps({
+        "memory_mb": {
+            "total": to_mb(mem.total),
+            "available": to_mb(mem.available),
+            "used": to_mb(mem.used),
+            "free": to_mb(mem.free),
+            "percent": mem.percent
+        },
+        "cpu_percent": psutil.cpu_percent(interval=None),
+        "server_time": datetime.utcnow().isoformat(),
+        "uptime_seconds": int(time.time() - BOOT_TIME)
+    })
 
 @app.route("/resources", methods=["GET"])
 def resource_check():
     """System resource metrics"""
+    global _resources_cache
     try:
-        # Memory metrics
-        mem = psutil.virtual_memory()
-        
-        # Convert bytes to MB
-        def to_mb(bytes_val):
-            return round(bytes_val / (1024 * 1024), 2)
+        with _resources_lock:
+            now = time.monotonic()
+            cached_at, body = _resources_cache
+            if body is None or now - cached_at > RESOURCES_CACHE_TTL:
+                body = build_resource_snapshot()
+                _resources_cache = (now, body)
         
-        return jsonify({
-            "memory_mb": {
-                "total": to_mb(mem.total),
-                "available": to_mb(mem.available),
-                "used": to_mb(mem.used),
-                "free": to_mb(mem.free),
-                "percent": mem.percent
-            },
-            "cpu_percent": psutil.cpu_percent(interval=1),
-            "server_time": datetime.utcnow().isoformat(),
-            "uptime_seconds": int(time.time() - psutil.boot_time())
-        })
+        return app.response_class(body, mimetype='application/json')
     except Exception as e:
-        return jsonify(error=str(e)), 500
+        return ojsonify({"error": str(e)}, 500)
 
 # ===== File Inspection Endpoint =====
 @app.route("/inspect/<job_id>", methods=["GET"])
@@ -365,35 +1014,44 @@ def inspect_job(job_id):
     """Inspect job files for debugging"""
     job_dir = os.path.join(app.config['UPLOAD_DIR'], f"apkjob_{job_id}")
     if not os.path.exists(job_dir):
-        return jsonify(error="Job not found"), 404
+        return ojsonify({"error": "Job not found"}, 404)
     
+    # scandir yields the entry type for free and one stat covers size + mtime
     files = []
-    for root, _, filenames in os.walk(job_dir):
-        for f in filenames:
-            fp = os.path.join(root, f)
-            files.append({
-                "path": fp,
-                "size": os.path.getsize(fp),
-                "modified": os.path.getmtime(fp)
-            })
+    pending = [job_dir]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                files.append({
+                    "path": entry.path,
+                    "size": stat.st_size,
+                    "modified": stat.st_mtime
+                })
     
-    return jsonify(files=files)
+    return ojsonify({"files": files})
 
 # ===== Background Services =====
 def background_cleaner():
-    """Background temp file cleanup service"""
-    while True:
-        try:
-            file_manager.cleanup_expired()
-            time.sleep(60)  # Check every minute
-        except Exception as e:
-            logger.error(f"Background cleaner error: {str(e)}")
-        time.sleep(60)
+    """Single reaper thread for all temp directories"""
+    file_manager.run_reaper()
+
+def start_background_services():
+    """Start this process's log listener and reaper thread"""
+    start_log_listener()
+    threading.Thread(target=background_cleaner, daemon=True).start()
 
-# Start background services
-threading.Thread(target=background_cleaner, daemon=True).start()
+# gunicorn_conf.py sets this and starts them from post_fork instead
+if os.environ.get("DEXAPI_SERVICES_AFTER_FORK") != "1":
+    start_background_services()
 
 if __name__ == "__main__":
+    # Production runs under gunicorn (start.sh); the Werkzeug server is for local debugging
+    if os.environ.get("FLASK_DEV") != "1":
+        raise SystemExit("Run with: gunicorn -c gunicorn_conf.py server:app (or set FLASK_DEV=1)")
     port = int(os.environ.get("PORT", 8080))
-    logger.info(f"🚀 Starting server on port {port}")
+    logger.info("🚀 Starting server on port %s", port)
     app.run(host="0.0.0.0", port=port, threaded=True)
\ No newline at end of file
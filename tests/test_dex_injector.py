@@ -0,0 +1,51 @@
+import struct
+
+from dex_injector import dex_defines_class
+
+FOO = b"Lcom/example/Foo;"
+BAR = b"Lcom/example/Bar;"
+
+
+def build_dex(strings, class_types):
+    """Minimal DEX: header, string_ids, type_ids (one per string) and class_defs"""
+    string_ids_off = 0x70
+    type_ids_off = string_ids_off + 4 * len(strings)
+    class_defs_off = type_ids_off + 4 * len(strings)
+    data_off = class_defs_off + 32 * len(class_types)
+
+    string_data = b""
+    string_offs = []
+    for value in strings:
+        string_offs.append(data_off + len(string_data))
+        string_data += bytes([len(value)]) + value + b"\0"
+
+    header = bytearray(0x70)
+    header[:8] = b"dex\n035\0"
+    struct.pack_into("<IIII", header, 0x38, len(strings), string_ids_off, len(strings), type_ids_off)
+    struct.pack_into("<II", header, 0x60, len(class_types), class_defs_off)
+
+    body = b"".join(struct.pack("<I", off) for off in string_offs)
+    body += b"".join(struct.pack("<I", i) for i in range(len(strings)))
+    body += b"".join(struct.pack("<I", type_idx) + bytes(28) for type_idx in class_types)
+    return bytes(header) + body + string_data
+
+
+def test_defined_class_found():
+    assert dex_defines_class(build_dex([BAR, FOO], [1]), FOO)
+
+
+def test_referenced_class_not_defined():
+    # FOO is only a type id here, the single class_def is BAR
+    assert not dex_defines_class(build_dex([BAR, FOO], [0]), FOO)
+
+
+def test_truncated_dex_not_defined():
+    dex = build_dex([BAR, FOO], [1])
+    assert not dex_defines_class(dex[:0x90], FOO)
+    assert not dex_defines_class(dex[:0x40], FOO)
+
+
+def test_out_of_range_offsets_not_defined():
+    dex = bytearray(build_dex([BAR, FOO], [1]))
+    struct.pack_into("<I", dex, 0x3C, 0xFFFFFF00)
+    assert not dex_defines_class(bytes(dex), FOO)